@@ -15,7 +15,8 @@ __all__ = [
 
 
 def smiles_analysis(smiles: list, path_to_export: str =None, download: bool =False, plots: list = None,
-                    save_plots:bool = False, fig_size: list = None, output_filter: bool =True) -> (dict, plt.figure):
+                    save_plots:bool = False, fig_size: list = None, output_filter: bool =True,
+                    mol_analysis: dict = None) -> (dict, plt.figure):
     """Function to analyze a list of SMILES. Builds on top of:
     https://github.com/awslabs/dgl-lifesci/blob/master/python/dgllife/utils/analysis.py.
 
@@ -41,6 +42,9 @@ def smiles_analysis(smiles: list, path_to_export: str =None, download: bool =Fal
         2-D list to set the figure sizes. Default: [10,6]
     output_filter: bool
         Filters the output of excessive output. Default: True (recommended).
+    mol_analysis: dict
+        An earlier result of dgllife's ``analyze_mols`` for the same smiles, which is then not computed again. It is
+        ignored if the results are exported, since the export is written during the analysis. Default: None
 
     Returns
     -------
@@ -58,7 +62,11 @@ def smiles_analysis(smiles: list, path_to_export: str =None, download: bool =Fal
         if not os.path.exists(path_to_export):
             os.mkdir(path_to_export)
 
-    dic = analyze_mols(smiles, path_to_export=path_to_export)
+    if mol_analysis is None or path_to_export is not None:
+        dic = analyze_mols(smiles, path_to_export=path_to_export)
+    else:
+        # Copied, since the filtering below removes keys
+        dic = dict(mol_analysis)
 
     # Filters some non
     if output_filter:
@@ -195,7 +195,7 @@ class AGC(nn.Module):
         super_new_graph, super_attention_weight = self.junction_module(junction_data, motif_nodes)
 
         # Sum features for motif graph
-        num_mols = len(junction_data.batch.unique(dim=0))
+        num_mols = junction_data.num_graphs
         frag_res = torch.zeros(num_mols, self.frag_res_dim, device=device)
         index = junction_data.batch.unsqueeze(1).expand(-1, self.frag_res_dim)
         frag_res = frag_res.scatter_add_(0, index, graph_frag)
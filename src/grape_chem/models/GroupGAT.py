@@ -216,10 +216,10 @@ class GCGAT_v4pro(nn.Module):
 
 
         #sum features for motif graph (akin to dgl.sum_nodes)
-        num_mols = len(junction_data.batch.unique(dim=0,))
+        num_mols = junction_data.num_graphs # known from the batching, unlike unique() this needs no sort or device sync
         frag_res = torch.zeros(num_mols, self.frag_res_dim, device=device) #vector that will contain the sums of the frags embedding of each mol
         index = junction_data.batch.unsqueeze(1).expand(-1, self.frag_res_dim)
-        frag_res = frag_res.scatter_add_(0, index, graph_frag)
+        frag_res = frag_res.scatter_add(0, index, graph_frag)
 
         #motifs_series = global_add_pool(junction_data.x, junction_data.batch) if get_attention else torch.zeros((graph_frag.x.size(0), 0), device=graph_frag.x.device)
         # 2. concat the output from different channels
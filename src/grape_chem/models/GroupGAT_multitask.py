@@ -246,18 +246,17 @@ class CpLayer(nn.Module):
         epsilon = 1e-7 # to avoid 0 division
         T = T + epsilon
 
-        D_over_T = torch.clamp(D / T, min=-1000, max=1000)
-        F_over_T = torch.clamp(F / T, min=-1000, max=1000)
+        # x/sinh(x) and x/cosh(x) are even, so they are written in terms of exp(-|x|), which cannot overflow in fp32
+        # the way sinh and cosh do past |x| ~ 89 (giving nan gradients); |D/T| is floored so x/sinh(x) tends to 1 at 0
+        D_over_T = torch.abs(D / T).clamp(min=epsilon)
+        F_over_T = torch.abs(F / T)
+        exp_D = torch.exp(-D_over_T)
+        exp_F = torch.exp(-F_over_T)
 
-        # print(f"D_over_T stats - min: {D_over_T.min()}, max: {D_over_T.max()}, mean: {D_over_T.mean()}")
-        # print(f"F_over_T stats - min: {F_over_T.min()}, max: {F_over_T.max()}, mean: {F_over_T.mean()}")
+        sinh_ratio = 2 * D_over_T * exp_D / -torch.expm1(-2 * D_over_T)
+        cosh_ratio = 2 * F_over_T * exp_F / (1 + exp_F * exp_F)
 
-        sinh_term = torch.sinh(D_over_T)
-        cosh_term = torch.cosh(F_over_T)
-        # print(f"sinh_term stats - min: {sinh_term.min()}, max: {sinh_term.max()}, mean: {sinh_term.mean()}")
-        # print(f"cosh_term stats - min: {cosh_term.min()}, max: {cosh_term.max()}, mean: {cosh_term.mean()}")
-
-        Cp = B + C * ((D_over_T / sinh_term) ** 2) + E * ((F_over_T / cosh_term) ** 2)
+        Cp = B + C * sinh_ratio ** 2 + E * cosh_ratio ** 2
         # Ensure T doesn't contain zero
         
         # Cp_o = B + C * ((D / T) / torch.sinh(D / T)) ** 2 + E * (
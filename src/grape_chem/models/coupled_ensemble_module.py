@@ -1,80 +1,228 @@
 import torch
 import torch.nn as nn
+from torch.func import functional_call, vmap
 from grape_chem.models import GroupGAT
 
-__all__ = ['GroupGAT_Ensemble', 'old_GroupGAT_Ensemble']
+try:
+    import triton
+    import triton.language as tl
+except ImportError:  # triton only ships with the linux builds of torch
+    triton = None
+
+__all__ = ['GroupGAT_Ensemble', 'SharedGroupGAT', 'old_GroupGAT_Ensemble']
 
 class GroupGAT_Ensemble(nn.Module):
     """
     the base code for the "coupled single task"
-    architecture
+    architecture. With share_backbone, the coefficients come
+    from one SharedGroupGAT built from the 'A' net_params.
+    Identical members are vectorized when no gradients are
+    needed; with vectorize, also in training.
     """
 
-    def __init__(self, net_params_per_model):
+    def __init__(self, net_params_per_model, *, share_backbone=False, vectorize=False):
         super().__init__()
-        self.device = net_params_per_model['A']['device']
-        self.models = nn.ModuleDict()
-        for model_name, net_params in net_params_per_model.items():
-            model = GroupGAT.GCGAT_v4pro(net_params)
-            self.models[model_name] = model
-        self.cp_layer = CpLayer()
-
-        self.A = None
-        self.B = None
-        self.C = None
-        self.D = None
-        self.E = None
+        self.device = torch.device(net_params_per_model['A']['device'])
+        self.share_backbone = share_backbone
+        # Vectorizing with gradients restacks the weights on every call and is slow for ops without a batching rule
+        # (gru_cell, the torch_scatter ops used on CUDA), so it is opt-in
+        self.vectorize = vectorize
+        if share_backbone:
+            # One graph encoder for all coefficients, which then only differ in their output heads
+            self.shared = SharedGroupGAT(net_params_per_model['A'])
+        else:
+            self.models = nn.ModuleDict()
+            for model_name, net_params in net_params_per_model.items():
+                model = GroupGAT.GCGAT_v4pro(net_params)
+                self.models[model_name] = model
+        self.cp_layer = _CP_LAYER
+
+        # The members can only be run as one vectorized model if they share their architecture and hyperparameters,
+        # e.g. the dropout rates, since the first member's modules are used for all of them
+        member_params = list(net_params_per_model.values())
+        self.vmap_members = not share_backbone and all(net_params == member_params[0] for net_params in member_params)
+
+        # Side streams on which the members are launched concurrently when they run one by one on a GPU
+        self.streams = None
+        if not share_backbone and self.device.type == 'cuda' and torch.cuda.is_available():
+            self.streams = [torch.cuda.Stream(device=self.device) for _ in 'ABCDE']
+
+        self._stacked = None  # stacked member weights reused between evaluation calls, see vmap_forward
+
+    def vmap_forward(self, data):
+        """Runs all members as one model vectorized over their stacked parameters, so every layer is evaluated once
+        for the whole ensemble instead of once per member. When gradients are needed, the parameters are stacked on
+        every call so they reach the members. In evaluation without gradients, the stacked copies are kept and only
+        rebuilt once a member's weights or buffers change. In training, the batch norm statistics updated on the
+        stacked buffers are written back to the members."""
+        members = [self.models[name] for name in 'ABCDE']
+        member_params = [dict(model.named_parameters()) for model in members]
+        member_buffers = [dict(model.named_buffers()) for model in members]
+        if self.training or torch.is_grad_enabled():
+            params = {name: torch.stack([p[name] for p in member_params]) for name in member_params[0]}
+            buffers = {name: torch.stack([b[name] for b in member_buffers]) for name in member_buffers[0]}
+        else:
+            # In-place updates (optimizer steps, load_state_dict) bump the version counters and moving the model
+            # changes the storage, either one invalidates the stacked copies
+            key = tuple((t.data_ptr(), t._version) for d in member_params + member_buffers for t in d.values())
+            if self._stacked is None or self._stacked[0] != key:
+                params = {name: torch.stack([p[name] for p in member_params]) for name in member_params[0]}
+                buffers = {name: torch.stack([b[name] for b in member_buffers]) for name in member_buffers[0]}
+                self._stacked = (key, params, buffers)
+            params, buffers = self._stacked[1], self._stacked[2]
+
+        def member_forward(params, buffers, data):
+            return functional_call(members[0], (params, buffers), (data,))
+
+        outputs = vmap(member_forward, in_dims=(0, 0, None), randomness='different')(params, buffers, data)
+        if self.training:
+            with torch.no_grad():
+                for i, member_buffer in enumerate(member_buffers):
+                    for name, buffer in member_buffer.items():
+                        buffer.copy_(buffers[name][i])
+        return outputs
+
+    def stream_forward(self, data):
+        """Launches every member on its own CUDA stream, so the kernels of members too small to fill the GPU can
+        overlap. The main stream waits on all of them before the outputs are combined."""
+        main_stream = torch.cuda.current_stream(self.device)
+        outputs = []
+        for name, stream in zip('ABCDE', self.streams):
+            stream.wait_stream(main_stream)  # the batch is prepared on the main stream
+            with torch.cuda.stream(stream):
+                outputs.append(self.models[name](data))
+        for stream, out in zip(self.streams, outputs):
+            main_stream.wait_stream(stream)
+            out.record_stream(main_stream)  # keep the allocator from reusing the output while the main stream reads it
+        return outputs
 
     def forward(self, data):
-        T = data.global_feats.to(self.device)
-        outputs = {}
-        for model_name, model in self.models.items():
-            outputs[model_name] = model(data)
-        self.A = outputs['A']
-        self.B = outputs['B']
-        self.C = outputs['C']
-        self.D = outputs['D']
-        self.E = outputs['E']
-        Cp = CpLayer()
-        return Cp(self.A, self.B, self.C, self.D, self.E, T)
+        T = data.global_feats
+        if T.device != self.device:
+            T = T.to(self.device, non_blocking=True)
+        outputs = None
+        if self.share_backbone:
+            outputs = self.shared(data)
+        elif self.vmap_members and (self.vectorize or not (self.training or torch.is_grad_enabled())):
+            try:
+                outputs = self.vmap_forward(data)
+            except RuntimeError as error:
+                # Ops without a batching rule (fx. custom extension ops) cannot be vectorized, the members are then
+                # run one by one from here on
+                print(f'The ensemble members could not be vectorized and are run one by one instead: {error}')
+                self.vmap_members = False
+        if outputs is None:
+            if self.streams is not None:
+                outputs = self.stream_forward(data)
+            else:
+                outputs = [self.models[name](data) for name in 'ABCDE']
+        A, B, C, D, E = outputs
+        return self.cp_layer(A, B, C, D, E, T)
+
+    def predict(self, data):
+        """Forward pass in inference mode, so no autograd state is recorded for evaluation and plotting. Unlike under
+        ``torch.no_grad``, the returned tensors are inference tensors and cannot be used in autograd afterwards."""
+        with torch.inference_mode():
+            return self.forward(data)
         
+class SharedGroupGAT(nn.Module):
+    """
+    A single GCGAT_v4pro encoder with one output head per
+    Cp coefficient, so the graph channels run once per batch
+    instead of once per coefficient.
+    """
+
+    def __init__(self, net_params):
+        super().__init__()
+        self.backbone = GroupGAT.GCGAT_v4pro(net_params)
+        # The backbone ends at its descriptors, the heads take the place of its last MLP
+        self.backbone.linear_predict2 = nn.Identity()
+        mid_dim = self.backbone.linear_predict1[1].out_features
+        self.heads = nn.ModuleDict()
+        for name in 'ABCDE':
+            head = nn.Sequential()
+            for _ in range(net_params['MLP_layers'] - 1):
+                head.append(nn.Linear(mid_dim, mid_dim, bias=True))
+                head.append(nn.LeakyReLU(negative_slope=0.001))
+            head.append(nn.Linear(mid_dim, 1, bias=True))
+            self.heads[name] = head
+
+    def forward(self, data):
+        descriptors = self.backbone(data)
+        return tuple(self.heads[name](descriptors) for name in 'ABCDE')
+
+
+@torch.jit.script
+def _cp_forward(B: torch.Tensor, C: torch.Tensor, D: torch.Tensor, E: torch.Tensor, F: torch.Tensor,
+                T: torch.Tensor) -> torch.Tensor:
+    """Scripted body of ``CpLayer``, so the elementwise operations can be fused into a single kernel instead of
+    launching one kernel per operation."""
+    epsilon = 1e-7  # to avoid division by zero
+    # The inputs come from the members and are never modified in place, only fresh intermediates whose values
+    # autograd does not keep are, so fewer temporaries are allocated when the operations are not fused
+    inv_T = (T.unsqueeze(1) + epsilon).reciprocal_()  # Ensure T has shape [700, 1]
+
+    # Clamp D_over_T and F_over_T to prevent extreme values
+    D_over_T = (D * inv_T).clamp_(min=-20., max=20.)
+    F_over_T = (F * inv_T).clamp_(min=-20., max=20.)
+
+    # With the arguments clamped to [-20, 20], sinh and cosh cannot overflow, so no exp based fallback is needed
+    sinh_ratio = D_over_T / torch.sinh(D_over_T).add_(epsilon)
+    cosh_ratio = F_over_T / torch.cosh(F_over_T).add_(epsilon)
+
+    Cp = torch.addcmul(B, C, sinh_ratio * sinh_ratio)
+    return torch.addcmul(Cp, E, cosh_ratio * cosh_ratio)
+
+
+if triton is not None:
+    @triton.autotune(configs=[triton.Config({'BLOCK': block}) for block in (256, 1024, 4096)], key=['N'])
+    @triton.jit
+    def _cp_kernel(B_ptr, C_ptr, D_ptr, E_ptr, F_ptr, T_ptr, O_ptr, N, BLOCK: tl.constexpr):
+        # Same computation as _cp_forward, reading every input and writing the output exactly once
+        offsets = tl.program_id(0) * BLOCK + tl.arange(0, BLOCK)
+        mask = offsets < N
+        T = tl.load(T_ptr + offsets, mask=mask, other=1.).to(tl.float32) + 1e-7
+        d = tl.load(D_ptr + offsets, mask=mask, other=0.).to(tl.float32) / T
+        f = tl.load(F_ptr + offsets, mask=mask, other=0.).to(tl.float32) / T
+        d = tl.minimum(tl.maximum(d, -20.), 20.)
+        f = tl.minimum(tl.maximum(f, -20.), 20.)
+        sinh_ratio = d / (tl.math.sinh(d) + 1e-7)
+        cosh_ratio = f / (tl.math.cosh(f) + 1e-7)
+        b = tl.load(B_ptr + offsets, mask=mask, other=0.).to(tl.float32)
+        c = tl.load(C_ptr + offsets, mask=mask, other=0.).to(tl.float32)
+        e = tl.load(E_ptr + offsets, mask=mask, other=0.).to(tl.float32)
+        Cp = b + c * sinh_ratio * sinh_ratio + e * cosh_ratio * cosh_ratio
+        tl.store(O_ptr + offsets, Cp, mask=mask)
+
+
+def _cp_layer_triton(B, C, D, E, F, T):
+    """Evaluates ``CpLayer`` with the fused triton kernel. The kernel has no backward, so it is only used when no
+    gradients are needed."""
+    T = T.unsqueeze(1).expand_as(B)
+    B, C, D, E, F, T = (x.contiguous() for x in (B, C, D, E, F, T))
+    out = torch.empty_like(B)
+    N = out.numel()
+    _cp_kernel[lambda meta: (triton.cdiv(N, meta['BLOCK']),)](B, C, D, E, F, T, out, N)
+    return out
+
+
 class CpLayer(nn.Module):
     def __init__(self):
         super(CpLayer, self).__init__()
 
     def forward(self, B, C, D, E, F, T):
-        epsilon = 1e-7  # to avoid division by zero
-        T = T.unsqueeze(1) + epsilon  # Ensure T has shape [700, 1]
-
-        # Clamp D_over_T and F_over_T to prevent extreme values
-        D_over_T = torch.clamp(D / T, min=-20, max=20)
-        F_over_T = torch.clamp(F / T, min=-20, max=20)
-
-        # Safe computations for sinh and cosh
-        def safe_sinh(x):
-            return torch.where(
-                torch.abs(x) <= 20,
-                torch.sinh(x),
-                torch.sign(x) * (torch.exp(torch.clamp(torch.abs(x), max=88)) / 2)
-            )
-
-        def safe_cosh(x):
-            return torch.where(
-                torch.abs(x) <= 20,
-                torch.cosh(x),
-                torch.exp(torch.clamp(torch.abs(x), max=88)) / 2
-            )
-
-        sinh_term = safe_sinh(D_over_T) + epsilon
-        cosh_term = safe_cosh(F_over_T) + epsilon
-
-        # Debugging statements
-        # print(f"D_over_T stats - min: {D_over_T.min()}, max: {D_over_T.max()}, mean: {D_over_T.mean()}")
-        # print(f"sinh_term stats - min: {sinh_term.min()}, max: {sinh_term.max()}, mean: {sinh_term.mean()}")
-
-        Cp = B + C * ((D_over_T / sinh_term) ** 2) + E * ((F_over_T / cosh_term) ** 2)
-        return Cp
-    
+        inputs = (B, C, D, E, F, T)
+        if (triton is not None and B.is_cuda
+                and not (torch.is_grad_enabled() and any(x.requires_grad for x in inputs))):
+            return _cp_layer_triton(*inputs)
+        return _cp_forward(*inputs)
+
+
+# CpLayer holds no parameters or state, so one instance (and its scripted and triton kernels, compiled on first use)
+# is shared by every ensemble built in the process
+_CP_LAYER = CpLayer()
+
+
 class old_GroupGAT_Ensemble(nn.Module):
     """
     the old way that doesn't support hyperparam optimization,
@@ -86,7 +234,7 @@ class old_GroupGAT_Ensemble(nn.Module):
         #     GroupGAT.GCGAT_v4pro_jit(net_params) for _ in range(num_targets)
         # ])
         # ^ If you want a model with variable number of coeffs, though it won't be jittable
-        self.device = net_params['device']
+        self.device = torch.device(net_params['device'])
         A_model = GroupGAT.GCGAT_v4pro(net_params)
         B_model = GroupGAT.GCGAT_v4pro(net_params)
         C_model = GroupGAT.GCGAT_v4pro(net_params)
@@ -99,14 +247,20 @@ class old_GroupGAT_Ensemble(nn.Module):
             'D': D_model,
             'E': E_model
         })
+        self.cp_layer = _CP_LAYER
 
     def forward(self, data):
-        T = data.global_feats.to(self.device)
-        outputs = []
+        T = data.global_feats
+        if T.device != self.device:
+            T = T.to(self.device, non_blocking=True)
         A = self.models['A'](data)
         B = self.models['B'](data)
         C = self.models['C'](data)
         D = self.models['D'](data)
         E = self.models['E'](data)
-        Cp = CpLayer()
-        return Cp(A, B, C, D, E, T)
\ No newline at end of file
+        return self.cp_layer(A, B, C, D, E, T)
+
+    def predict(self, data):
+        """See ``GroupGAT_Ensemble.predict``."""
+        with torch.inference_mode():
+            return self.forward(data)
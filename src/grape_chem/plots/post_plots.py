@@ -1,11 +1,13 @@
 # analysis tools
 
 import os
+import functools
 from typing import Optional, Union
 from torch import Tensor
 from numpy import ndarray
 import numpy as np
 import pandas as pd
+import matplotlib
 import matplotlib.pyplot as plt
 import seaborn as sns
 from grape_chem.utils.data import DataSet
@@ -18,6 +20,38 @@ __all__ = [
     'residual_density_plot'
 ]
 
+# Batch runs can set GRAPE_HEADLESS_PLOTS to render without a GUI toolkit, the figures are then closed once drawn
+_HEADLESS_PLOTS = bool(os.environ.get('GRAPE_HEADLESS_PLOTS'))
+if _HEADLESS_PLOTS:
+    matplotlib.use('Agg')
+
+
+@functools.lru_cache(maxsize=None)
+def _make_export_dir(path: str) -> str:
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _default_export_dir() -> str:
+    """The analysis_results folder of the working directory, created on first use only, so plots logged every
+    epoch do not check the filesystem each time."""
+    return _make_export_dir(os.getcwd() + '/analysis_results')
+
+
+def _subsample(n: int, max_points: int, strata: ndarray = None) -> ndarray:
+    """Indices of about max_points of n points drawn at random, spread over the deciles of strata if given, so a
+    color coding keeps its coverage."""
+    rng = np.random.default_rng(0)
+    if strata is None:
+        return np.sort(rng.choice(n, max_points, replace=False))
+    strata = np.asarray(strata).ravel()
+    groups = np.digitize(strata, np.quantile(strata, np.linspace(0, 1, 11)[1:-1]))
+    idx = []
+    for group in np.unique(groups):
+        members = np.flatnonzero(groups == group)
+        idx.append(rng.choice(members, min(len(members), round(len(members) * max_points / n)), replace=False))
+    return np.sort(np.concatenate(idx))
+
 
 def loss_plot(losses, model_names, early_stop_epoch: int = None, fig_size: tuple = (10,5),
                               save_fig: bool = False, path_to_export: str = None) -> sns.lineplot:
@@ -43,34 +77,36 @@ def loss_plot(losses, model_names, early_stop_epoch: int = None, fig_size: tuple
     """
 
     if save_fig and (path_to_export is None):
+        path_to_export = _default_export_dir()
 
-        path_to_export = os.getcwd() + '/analysis_results'
-
-        if not os.path.exists(path_to_export):
-            os.mkdir(path_to_export)
-
-    loss_dic = dict()
-    for idx, name in enumerate(model_names):
-        loss_dic[name] = losses[idx]
+    # Filled into one float32 array, curves of different lengths are padded with nan
+    loss_arr = np.full((max(len(loss) for loss in losses[:len(model_names)]), len(model_names)), np.nan,
+                       dtype=np.float32)
+    for idx in range(len(model_names)):
+        loss_arr[:len(losses[idx]), idx] = losses[idx]
 
-    df = pd.DataFrame(loss_dic)
+    df = pd.DataFrame(loss_arr, columns=model_names, copy=False)
 
     fig, ax = plt.subplots(figsize=fig_size)
-    sns.lineplot(data=df)
-    ax.set_xlabel('Epochs')
-    ax.set_ylabel('Loss')
-    if early_stop_epoch is not None:
-        plt.axvline(x=early_stop_epoch, linestyle='--', color='r', label='Early Stop')
-        plt.legend(loc='best')
-
-    if path_to_export is not None:
-        fig.savefig(fname=f'{path_to_export}/loss_plot.svg', format='svg')
+    try:
+        sns.lineplot(data=df)
+        ax.set_xlabel('Epochs')
+        ax.set_ylabel('Loss')
+        if early_stop_epoch is not None:
+            plt.axvline(x=early_stop_epoch, linestyle='--', color='r', label='Early Stop')
+            plt.legend(loc='best')
+
+        if path_to_export is not None:
+            fig.savefig(fname=f'{path_to_export}/loss_plot.svg', format='svg')
+    finally:
+        if _HEADLESS_PLOTS:
+            plt.close(fig)
 
     return
 
 def parity_plot(prediction: Union[Tensor, ndarray], target:  Union[Tensor, ndarray], mol_weights: ndarray = None,
                 fig_size: tuple = (10,5), save_fig: bool = False, path_to_export: str = None,
-                rescale_data: DataSet = None) -> plt.axes:
+                rescale_data: DataSet = None, max_points: Optional[int] = 20000) -> plt.axes:
     """Generates a parity plot based on the given predictions and targets.
 
     Parameters
@@ -89,6 +125,9 @@ def parity_plot(prediction: Union[Tensor, ndarray], target:  Union[Tensor, ndarr
         File location to save. Default: None
     rescale_data: DataSet
         Optional, will be used to rescale the predictions and targets if provided.
+    max_points: int
+        Optional, the number of points is randomly reduced to about this many, which looks the same but renders much
+        faster for large sets. None plots all points. Default: 20000
 
     Returns
     -------
@@ -99,11 +138,7 @@ def parity_plot(prediction: Union[Tensor, ndarray], target:  Union[Tensor, ndarr
     assert len(prediction) == len(target), 'Predictions and targets are not the same size.'
 
     if save_fig and (path_to_export is None):
-
-        path_to_export = os.getcwd() + '/analysis_results'
-
-        if not os.path.exists(path_to_export):
-            os.mkdir(path_to_export)
+        path_to_export = _default_export_dir()
 
     if isinstance(prediction, Tensor):
         prediction = prediction.cpu().detach().numpy()
@@ -114,33 +149,43 @@ def parity_plot(prediction: Union[Tensor, ndarray], target:  Union[Tensor, ndarr
         prediction = rescale_data.rescale_data(prediction)
         target = rescale_data.rescale_data(target)
 
-    min_val = min(np.min(prediction), np.min(target))
-    max_val = max(np.max(prediction), np.max(target))
+    both = np.concatenate([np.ravel(prediction), np.ravel(target)])
+    min_val, max_val = both.min(), both.max()
 
+    if max_points is not None and len(prediction) > max_points:
+        idx = _subsample(len(prediction), max_points, mol_weights)
+        prediction, target = prediction[idx], target[idx]
+        if mol_weights is not None:
+            mol_weights = np.asarray(mol_weights)[idx]
 
     fig, ax = plt.subplots(1,1,figsize=fig_size)
-    if mol_weights is not None:
-        p = ax.scatter(target, prediction, linewidth = 0.7, c=mol_weights, cmap='plasma')
-        fig.colorbar(p, ax=ax, orientation='vertical', label='Molar Weight')
-    else:
-        ax.scatter(target, prediction, linewidth=0.7)
-    ax.axline((0,0), slope=1, color='black')
-    ax.set_title('Parity plot')
-    ax.set_xlabel('Ground truth')
-    ax.set_ylabel('Prediction')
-    plt.xlim(min_val,max_val)
-    plt.ylim(min_val,max_val)
-    ax.set_aspect('equal', adjustable='box')
-
-
-    if path_to_export is not None:
-        fig.savefig(fname=f'{path_to_export}/parity_plot.svg', format='svg')
+    try:
+        if mol_weights is not None:
+            p = ax.scatter(target, prediction, linewidth = 0.7, c=mol_weights, cmap='plasma')
+            fig.colorbar(p, ax=ax, orientation='vertical', label='Molar Weight')
+        else:
+            ax.scatter(target, prediction, linewidth=0.7)
+        ax.axline((0,0), slope=1, color='black')
+        ax.set_title('Parity plot')
+        ax.set_xlabel('Ground truth')
+        ax.set_ylabel('Prediction')
+        plt.xlim(min_val,max_val)
+        plt.ylim(min_val,max_val)
+        ax.set_aspect('equal', adjustable='box')
+
+
+        if path_to_export is not None:
+            fig.savefig(fname=f'{path_to_export}/parity_plot.svg', format='svg')
+    finally:
+        if _HEADLESS_PLOTS:
+            plt.close(fig)
 
     return ax
 
 
 def residual_plot(prediction: Union[Tensor, ndarray], target: Union[Tensor, ndarray], fig_size: tuple = (10,5),
-                    save_fig: bool = False, path_to_export: str = None, rescale_data: DataSet = None) -> plt.axes:
+                    save_fig: bool = False, path_to_export: str = None, rescale_data: DataSet = None,
+                    max_points: Optional[int] = 20000) -> plt.axes:
     """Generates a parity plot based on the given predictions and targets.
 
     Parameters
@@ -157,6 +202,9 @@ def residual_plot(prediction: Union[Tensor, ndarray], target: Union[Tensor, ndar
         File location to save. Default: None
     rescale_data: DataSet
         Optional, will be used to rescale the predictions and targets if provided.
+    max_points: int
+        Optional, the number of points is randomly reduced to about this many, which looks the same but renders much
+        faster for large sets. None plots all points. Default: 20000
 
     Returns
     -------
@@ -167,11 +215,7 @@ def residual_plot(prediction: Union[Tensor, ndarray], target: Union[Tensor, ndar
     assert len(prediction) == len(target), 'Predictions and targets are not the same size.'
 
     if save_fig and (path_to_export is None):
-
-        path_to_export = os.getcwd() + '/analysis_results'
-
-        if not os.path.exists(path_to_export):
-            os.mkdir(path_to_export)
+        path_to_export = _default_export_dir()
 
     if isinstance(prediction, Tensor):
         prediction = prediction.cpu().detach().numpy()
@@ -184,15 +228,23 @@ def residual_plot(prediction: Union[Tensor, ndarray], target: Union[Tensor, ndar
 
     residual = prediction-target
 
-    fig, ax = plt.subplots(1,1,figsize=fig_size)
-    ax.scatter(target, residual, linewidth = 0.7)
-    ax.axline((0,0), slope=0, color='black')
-    ax.set_title('Residual plot')
-    ax.set_xlabel('Ground truth')
-    ax.set_ylabel('Residual')
+    if max_points is not None and len(residual) > max_points:
+        idx = _subsample(len(residual), max_points)
+        target, residual = target[idx], residual[idx]
 
-    if path_to_export is not None:
-        fig.savefig(fname=f'{path_to_export}/residual_plot.svg', format='svg')
+    fig, ax = plt.subplots(1,1,figsize=fig_size)
+    try:
+        ax.scatter(target, residual, linewidth = 0.7)
+        ax.axline((0,0), slope=0, color='black')
+        ax.set_title('Residual plot')
+        ax.set_xlabel('Ground truth')
+        ax.set_ylabel('Residual')
+
+        if path_to_export is not None:
+            fig.savefig(fname=f'{path_to_export}/residual_plot.svg', format='svg')
+    finally:
+        if _HEADLESS_PLOTS:
+            plt.close(fig)
 
     return ax
 
@@ -233,49 +285,49 @@ def residual_density_plot(train_pred:Union[Tensor, ndarray], val_pred: Union[Ten
 
     """
 
-    all_ = [train_pred, val_pred, test_pred, train_target, val_target, test_target]
-
+    preds, targets = [train_pred, val_pred, test_pred], [train_target, val_target, test_target]
 
-    assert len(train_target) == len(train_pred), 'Predictions and targets are not the same size.'
+    assert all(len(pred) == len(target) for pred, target in zip(preds, targets)), \
+        'Predictions and targets are not the same size.'
 
     if save_fig and (path_to_export is None):
+        path_to_export = _default_export_dir()
 
-        path_to_export = os.getcwd() + '/analysis_results'
-
-        if not os.path.exists(path_to_export):
-            os.mkdir(path_to_export)
-
-    for i in range(len(all_)):
-        if isinstance(all_[i], Tensor):
-            all_[i] = all_[i].cpu().detach().numpy()
-        if rescale_data is not None:
-            all_[i] = rescale_data.rescale_data(all_[i])
-
-    train_pred, val_pred, test_pred, train_target, val_target, test_target = all_
-    residual_train = train_pred-train_target
-    residual_val = val_pred-val_target
-    residual_test = test_pred-test_target
+    # All six arrays are stacked so they are rescaled in one pass and the residuals taken in one subtraction
+    all_ = [x.cpu().detach().numpy() if isinstance(x, Tensor) else np.asarray(x) for x in preds + targets]
+    all_ = np.concatenate([x.reshape(len(x), -1) for x in all_])
+    if rescale_data is not None:
+        all_ = rescale_data.rescale_data(all_)
 
-    from matplotlib.pyplot import rcParams
-    rcParams['figure.figsize'] = fig_size
+    sizes = [len(pred) for pred in preds]
+    residual = all_[:sum(sizes)] - all_[sum(sizes):]
+    if residual.shape[1] == 1:
+        residual = residual[:, 0]
+    residual_train, residual_val, residual_test = np.split(residual, np.cumsum(sizes)[:-1])
 
     lim = max(np.abs(residual_train).max(), np.abs(residual_val).max(), np.abs(residual_test).max())
     lim += 0.5*lim
 
-    sns.histplot(data=residual_train, bins=70,kde=True, color='blue', edgecolor="black", label='train')
-    sns.histplot(data=residual_val,bins=70, kde=True, color='green', edgecolor="black", label='val')
-    sns.histplot(data=residual_test, bins=70, kde=True, color='red', edgecolor="black", label='test')
-    # green
-    plt.xlabel('mpC', fontsize=16, fontweight='bold')
-    plt.ylabel('Count', fontsize=16, fontweight='bold')
-    plt.tight_layout()
-    plt.xlim((-lim,lim))
-    sns.despine(top=False, right=False)
-    plt.xticks(fontsize=16, fontweight='bold')
-    plt.yticks(fontsize=16, fontweight='bold')
-    plt.legend()
-    plt.show()
-
-    if path_to_export is not None:
-        plt.savefig(fname=f'{path_to_export}/residual_plot.svg', format='svg')
-
+    fig = plt.figure(figsize=fig_size)
+    try:
+        sns.histplot(data=residual_train, bins=70,kde=True, color='blue', edgecolor="black", label='train')
+        sns.histplot(data=residual_val,bins=70, kde=True, color='green', edgecolor="black", label='val')
+        sns.histplot(data=residual_test, bins=70, kde=True, color='red', edgecolor="black", label='test')
+        # green
+        plt.xlabel('mpC', fontsize=16, fontweight='bold')
+        plt.ylabel('Count', fontsize=16, fontweight='bold')
+        plt.tight_layout()
+        plt.xlim((-lim,lim))
+        sns.despine(top=False, right=False)
+        plt.xticks(fontsize=16, fontweight='bold')
+        plt.yticks(fontsize=16, fontweight='bold')
+        plt.legend()
+
+        # saved before showing, since showing can release the figure
+        if path_to_export is not None:
+            fig.savefig(fname=f'{path_to_export}/residual_plot.svg', format='svg')
+        if not _HEADLESS_PLOTS:
+            plt.show()
+    finally:
+        if _HEADLESS_PLOTS:
+            plt.close(fig)
@@ -4,7 +4,9 @@ import os
 from typing import Optional, Union
 from torch import Tensor
 from numpy import ndarray
+import numpy as np
 import matplotlib.pyplot as plt
+from grape_chem.plots.post_plots import _HEADLESS_PLOTS, _default_export_dir
 
 __all__ = [
     "williams_plot"
@@ -12,8 +14,8 @@ __all__ = [
 
 def williams_plot(prediction: Union[Tensor, ndarray], target: Union[Tensor, ndarray], n_features: int,
                   fig_size: tuple = (10,5), save_fig: bool = False, path_to_export: str = None) -> plt.axes:
-    """Generates a williams plot based on the given predictions and targets. The plot is based on the formula:
-    X/(X X')X', where the X matrix are the targets.
+    """Generates a williams plot based on the given predictions and targets. The hat values are the diagonal of the
+    hat matrix: X(X'X)^-1X', where the X matrix are the targets.
     This plot is used to expose observations
     that are far from the mean of the residuals, thus exerting a lot of influence on the parameter training.
 
@@ -43,29 +45,32 @@ def williams_plot(prediction: Union[Tensor, ndarray], target: Union[Tensor, ndar
     assert len(prediction) == len(target), 'Predictions and targets are not the same size.'
 
     if save_fig and (path_to_export is None):
-
-        path_to_export = os.getcwd() + '/analysis_results'
-
-        if not os.path.exists(path_to_export):
-            os.mkdir(path_to_export)
+        path_to_export = _default_export_dir()
 
     if isinstance(prediction, Tensor):
         prediction = prediction.cpu().detach().numpy()
     if isinstance(target, Tensor):
         target = target.cpu().detach().numpy()
 
-    residual = target-prediction
-    hat = (target@target@target.T@target.T)
-    N = len(residual)
+    N = len(target)
+    X = np.asarray(target, dtype=np.float64).reshape(N, -1)
+    residual = X - np.asarray(prediction, dtype=np.float64).reshape(N, -1)
 
-    fig, ax = plt.subplots(1,1,figsize=fig_size)
-    ax.scatter(hat, residual, linewidth = 0.7)
-    ax.axvline(3*n_features/N)
-    ax.set_title('Williams plot')
-    ax.set_xlabel('Hat values')
-    ax.set_ylabel('Residuals')
+    # Only the diagonal of the hat matrix is needed: h_ii = x_i (X'X)^-1 x_i', so the N x N matrix is never formed
+    hat = np.einsum('ij,ji->i', X, np.linalg.solve(X.T @ X, X.T))
 
-    if path_to_export is not None:
-        fig.savefig(fname=f'{path_to_export}/williams_plot.svg', format='svg')
+    fig, ax = plt.subplots(1,1,figsize=fig_size)
+    try:
+        ax.scatter(np.repeat(hat, residual.shape[1]), residual.ravel(), linewidth = 0.7)
+        ax.axvline(3*n_features/N)
+        ax.set_title('Williams plot')
+        ax.set_xlabel('Hat values')
+        ax.set_ylabel('Residuals')
+
+        if path_to_export is not None:
+            fig.savefig(fname=f'{path_to_export}/williams_plot.svg', format='svg')
+    finally:
+        if _HEADLESS_PLOTS:
+            plt.close(fig)
 
     return ax
\ No newline at end of file
@@ -1,7 +1,11 @@
 # Graph constructor built on top of pytorch geometric
 
 import os
+import functools
+import multiprocessing
 from collections.abc import Sequence
+import tempfile
+import zipfile
 from typing import Union
 
 import pickle
@@ -18,7 +22,6 @@ from rdkit.Chem import rdmolops, MolFromSmiles, Draw, MolToSmiles
 from rdkit import RDLogger
 
 from torch_geometric.data import Data, HeteroData, Batch
-from torch_geometric.utils import dense_to_sparse
 
 from grape_chem.utils.featurizer import AtomFeaturizer, BondFeaturizer
 #from grape_chem.analysis import smiles_analysis
@@ -41,9 +44,57 @@ __all__ = ['filter_smiles',
 ########### filtering ####################################################
 ##########################################################################
 
+def _parse_smiles(smiles: list[str], num_workers: int = 1):
+    """Yields ``(index, mol)`` pairs for the given smiles. For more than one worker, the smiles are parsed by RDKit's
+    MultithreadedSmilesMolSupplier, which parses in C++ threads and streams the mols back, so only a few mols are
+    held in memory at once. The pairs are then **not** yielded in input order.
+
+    Parameters
+    ------------
+    smiles: list of str
+        Smiles to be parsed.
+    num_workers: int
+        Number of parsing threads. Values of 1 or less parse serially with ``Chem.MolFromSmiles``. Default: 1
+
+    """
+    if num_workers <= 1:
+        for idx, element in enumerate(smiles):
+            yield idx, Chem.MolFromSmiles(element)
+        return
+
+    # The supplier reads one smiles per line and skips empty lines, which would shift the record ids. Smiles that
+    # are empty or contain whitespace are therefore parsed directly.
+    lines, line_indices = [], []
+    for idx, element in enumerate(smiles):
+        if isinstance(element, str) and element and len(element.split()) == 1 and element == element.strip():
+            lines.append(element)
+            line_indices.append(idx)
+        else:
+            yield idx, Chem.MolFromSmiles(element)
+
+    if not lines:
+        return
+
+    with tempfile.NamedTemporaryFile('w', suffix='.smi', delete=False) as handle:
+        handle.write('\n'.join(lines))
+        file_name = handle.name
+
+    try:
+        supplier = Chem.MultithreadedSmilesMolSupplier(file_name, delimiter='\t', smilesColumn=0, nameColumn=-1,
+                                                       titleLine=False, numWriterThreads=num_workers)
+        for mol in supplier:
+            record = supplier.GetLastRecordId()
+            if record <= len(lines):
+                yield line_indices[record - 1], mol
+        del supplier
+    finally:
+        os.remove(file_name)
+
+
 def filter_smiles(smiles: list[str], target: Union[list[str], list[float], ndarray], allowed_atoms: list[str] = None,
                   only_organic: bool = True, allow_dupes: bool = False, log: bool = False,
-                  global_feats = None, custom_split=None, target_columns=None) -> Union[list,list]:
+                  global_feats = None, custom_split=None, target_columns=None,
+                  num_workers: int = None, return_mols: bool = False) -> Union[list,list]:
     """Filters a list of smiles based on the allowed atom symbols.
 
     Parameters
@@ -66,6 +117,13 @@ def filter_smiles(smiles: list[str], target: Union[list[str], list[float], ndarr
         The custom split array calculated on the dataset before filtering. Default: None
     target_columns: list of str
         In the case of multi dimensional targets, we specify the columns that should also be filtered. Default: None
+    num_workers: int
+        Number of threads used to parse the smiles with RDKit's MultithreadedSmilesMolSupplier. Values of 1 or less
+        parse the smiles serially. Default: ``os.cpu_count()``
+    return_mols: bool
+        If set to True, the parsed RDKit mols of the kept smiles are returned as well, with their atoms in the order of
+        the returned smiles. They can be passed on to ``construct_dataset`` to skip parsing the smiles again.
+        Default: False
     Returns
     ----------
     list[str]
@@ -76,75 +134,109 @@ def filter_smiles(smiles: list[str], target: Union[list[str], list[float], ndarr
     if allowed_atoms is None:
         allowed_atoms = ['C', 'N', 'O', 'S', 'F', 'Cl', 'Br', 'I', 'P']
 
-    if target_columns is None:
-        if global_feats is not None:
-            df = pd.DataFrame({'smiles': smiles, 'target': target, 'global_feat': global_feats})
-        else:
-            df = pd.DataFrame({'smiles': smiles, 'target': target,})
-    else:
-        target_df = pd.DataFrame(target, columns=target_columns)
-        df = pd.DataFrame({'smiles': smiles})
-        df = pd.concat([df.reset_index(drop=True), target_df.reset_index(drop=True)], axis=1)
-    
-    if custom_split is not None:
-        df['split'] = custom_split
+    if target_columns is not None:
+        target = pd.DataFrame(target, columns=target_columns)
+
+    for name, values in [('target', target), ('global_feats', global_feats), ('custom_split', custom_split)]:
+        if values is not None and len(values) != len(smiles):
+            raise ValueError(f'The length of {name} ({len(values)}) does not match the number of smiles '
+                             f'({len(smiles)}).')
 
-    indices_to_drop = []
+    # Checked for every atom of every molecule, so a hash lookup is used instead of a list scan
+    allowed_set = frozenset(allowed_atoms)
 
-    for idx, element in enumerate(df.smiles):
-        mol = Chem.MolFromSmiles(element)
+    # Instead of building and dropping rows of a DataFrame, we flip a mask for every rejected molecule and
+    # only gather the kept entries once at the end.
+    keep_mask = [True] * len(smiles)
+    canonical_smiles = [None] * len(smiles)
+    mols = [None] * len(smiles) if return_mols else None
+
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+
+    # Parsed mols are matched back to their position in the input
+    smiles = list(smiles)
+
+    # The mols may arrive out of order from the parsing threads, so the reasons for dropping a smiles are collected
+    # and printed in input order afterward.
+    messages = {}
+
+    for idx, mol in _parse_smiles(smiles, num_workers):
+        element = smiles[idx]
 
         if mol is None:
             if log:
-                print(f'SMILES {element} in index {idx} is not valid.')
-            indices_to_drop.append(idx)
+                messages[idx] = f'SMILES {element} in index {idx} is not valid.'
+            keep_mask[idx] = False
             continue  # Move to the next SMILES
 
         if mol.GetNumHeavyAtoms() < 2:
             if log:
-                print(f'SMILES {element} in index {idx} consists of less than 2 heavy atoms and will be ignored.')
-            indices_to_drop.append(idx)
+                messages[idx] = (f'SMILES {element} in index {idx} consists of less than 2 heavy atoms and will be '
+                                 f'ignored.')
+            keep_mask[idx] = False
             continue
 
         carbon_count = 0
         invalid_atom = False
         for atom in mol.GetAtoms():
-            if atom.GetSymbol() not in allowed_atoms:
+            symbol = atom.GetSymbol()
+            if symbol not in allowed_set:
                 if log:
-                    print(f'SMILES {element} in index {idx} contains the atom {atom.GetSymbol()} that is not permitted and will be ignored.')
-                indices_to_drop.append(idx)
+                    messages[idx] = (f'SMILES {element} in index {idx} contains the atom {symbol} that is not '
+                                     f'permitted and will be ignored.')
+                keep_mask[idx] = False
                 invalid_atom = True
                 break  # No need to check further atoms
-            if atom.GetSymbol() == 'C':
+            if symbol == 'C':
                 carbon_count += 1
 
         if invalid_atom:
             continue  # Skip to the next SMILES
 
         if carbon_count < 1 and only_organic:
-            indices_to_drop.append(idx)
+            keep_mask[idx] = False
             if log:
-                print(f'SMILES {element} in index {idx} does not contain at least one carbon and will be ignored.')
+                messages[idx] = (f'SMILES {element} in index {idx} does not contain at least one carbon and will be '
+                                 f'ignored.')
+            continue
 
-    df.drop(indices_to_drop, inplace=True)
-    df.reset_index(drop=True, inplace=True)
+        # Map the already parsed mol back to smiles to ensure SMILES notation consistency
+        canonical_smiles[idx] = Chem.MolToSmiles(mol)
+        if return_mols:
+            # The atoms are renumbered into the order of the canonical smiles, so the mol matches a fresh parse of the
+            # returned smiles
+            mols[idx] = Chem.RenumberAtoms(mol, list(mol.GetPropsAsDict(True, True)['_smilesAtomOutputOrder']))
 
-    # Map smiles to mol and back to ensure SMILES notation consistency
-    mols = df.smiles.map(lambda x: Chem.MolFromSmiles(x))
-    df.smiles = mols.map(lambda x: Chem.MolToSmiles(x))
+    if log:
+        for idx in sorted(messages):
+            print(messages[idx])
 
     if not allow_dupes:
-        df.drop_duplicates(subset='smiles', inplace=True)
-        df.reset_index(drop=True, inplace=True)
+        # Duplicates are found with a single hash pass over the canonical smiles, before any featurization. The first
+        # occurrence of a molecule is kept.
+        seen = set()
+        num_dupes = 0
+        for idx, keep in enumerate(keep_mask):
+            if not keep:
+                continue
+            if canonical_smiles[idx] in seen:
+                keep_mask[idx] = False
+                num_dupes += 1
+            else:
+                seen.add(canonical_smiles[idx])
+        if log and num_dupes > 0:
+            print(f'{num_dupes} duplicate SMILES were removed, {len(seen)} unique SMILES are kept.')
+
+    kept = [idx for idx, keep in enumerate(keep_mask) if keep]
 
-    smiles = np.array(df.smiles)
+    smiles = np.array([canonical_smiles[idx] for idx in kept], dtype=object)
+    target = np.asarray(target)[kept]
+    global_feat = np.asarray(global_feats)[kept] if global_feats is not None else None
+    split = np.asarray(custom_split)[kept] if custom_split is not None else None
 
-    if target_columns is None:
-        target = np.array(df.target)
-    else:
-        target = np.array(df[target_columns])
-    global_feat = np.array(df.global_feat) if global_feats is not None else None
-    split = np.array(df.split) if custom_split is not None else None
+    if return_mols:
+        return smiles, target, global_feat, split, [mols[idx] for idx in kept]
 
     return smiles, target, global_feat, split
 
@@ -153,9 +245,84 @@ def filter_smiles(smiles: list[str], target: Union[list[str], list[float], ndarr
 ########### constructing a dataset #######################################
 ##########################################################################
 
+# Featurizers of a construct_dataset worker process, set once per worker by the pool initializer
+_worker_featurizers = None
+
+
+def _init_featurize_worker(atom_featurizer: AtomFeaturizer, bond_featurizer: BondFeaturizer):
+    global _worker_featurizers
+    _worker_featurizers = (atom_featurizer, bond_featurizer)
+
+
+def _smile_to_graph(smile: str, atom_featurizer: AtomFeaturizer, bond_featurizer: BondFeaturizer,
+                    y_value: Tensor = None, global_feat_value: Tensor = None, graph_only: bool = False,
+                    mol: Chem.Mol = None) -> Data:
+    """Featurizes a single smile, or its already parsed mol, into a PyG Data object, see ``construct_dataset``."""
+    if mol is None:
+        mol = MolFromSmiles(smile)  # get into rdkit object
+    # The edges are read off the bonds directly instead of scanning the dense N x N adjacency matrix. Each bond gives
+    # the two directed edges (u, v) and (v, u) next to each other, the same order the bond featurizer uses.
+    bonds = mol.GetBonds()
+    src = np.empty(2 * len(bonds), dtype=np.int64)
+    dst = np.empty_like(src)
+    for i, bond in enumerate(bonds):
+        u, v = bond.GetBeginAtomIdx(), bond.GetEndAtomIdx()
+        src[2 * i], dst[2 * i] = u, v
+        src[2 * i + 1], dst[2 * i + 1] = v, u
+    edge_index = torch.from_numpy(np.stack([src, dst]))
+    x = atom_featurizer(mol)  # creates node features
+    edge_attr = bond_featurizer(mol)  # creates edge attributes
+
+    if graph_only:
+        return Data(x=x, edge_index=edge_index, edge_attr=edge_attr)
+
+    data_temp = Data(x=x, edge_index=edge_index, edge_attr=edge_attr, y=y_value)
+    data_temp['global_feats'] = global_feat_value
+
+    return data_temp
+
+
+@functools.lru_cache(maxsize=16)
+def _get_featurizers(allowed_atoms: tuple = None, atom_feature_list: tuple = None,
+                     bond_feature_list: tuple = None) -> tuple[AtomFeaturizer, BondFeaturizer]:
+    """Returns the atom and bond featurizers of ``construct_dataset``, memoized on their settings, since the same
+    settings are used for every call on a dataset (fx. when rebuilding the graphs in ``split_and_scale``). The
+    featurizers are never handed out of this module, so sharing them between calls is safe."""
+    atom_featurizer = AtomFeaturizer(allowed_atoms=list(allowed_atoms) if allowed_atoms is not None else None,
+                                     atom_feature_list=list(atom_feature_list) if atom_feature_list is not None else None)
+
+    bond_featurizer = BondFeaturizer(bond_feature_list=list(bond_feature_list) if bond_feature_list is not None else None)
+
+    return atom_featurizer, bond_featurizer
+
+
+def _as_1d_tensor(value) -> Tensor:
+    """Converts a target or global feature entry of a single graph into a float tensor that is at least 1-dimensional."""
+    value = torch.tensor(value, dtype=torch.float32)
+    if value.ndim == 0:
+        value = value.unsqueeze(0)
+    return value
+
+
+def _featurize_one(args: tuple) -> bytes:
+    """Pool task of ``construct_dataset``. Cached mols are sent as RDKit binaries with all their properties, since
+    the default pickling drops computed properties (fx. the CIP codes used by the chirality features).
+
+    No tensors cross the process boundary: the target and global feature entries arrive as plain values and the graph
+    is returned pickled. Tensors passed through a pool are moved to shared memory instead, each holding an open file
+    descriptor, which runs out of descriptors on large datasets."""
+    smile, mol_binary, y_value, global_feat_value = args
+    atom_featurizer, bond_featurizer = _worker_featurizers
+    mol = Chem.Mol(mol_binary) if mol_binary is not None else None
+    global_feat_value = _as_1d_tensor(global_feat_value) if global_feat_value is not None else None
+    data = _smile_to_graph(smile, atom_featurizer, bond_featurizer, _as_1d_tensor(y_value), global_feat_value, mol=mol)
+    return pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+
+
 def construct_dataset(smiles: list[str], target: Union[list[int], list[float], ndarray], allowed_atoms: list[str] = None,
                       atom_feature_list: list[str] = None, bond_feature_list: list[str] = None,
-                      global_features = None, graph_only: bool = False) -> list[Data]:
+                      global_features = None, graph_only: bool = False, num_workers: int = 1,
+                      mols: list[Chem.Mol] = None) -> list[Data]:
     """Constructs a dataset out of the smiles and target lists based on the feature lists provided. The dataset will be
     a list of torch geometric Data objects, using their conventions.
 
@@ -176,6 +343,13 @@ def construct_dataset(smiles: list[str], target: Union[list[int], list[float], n
         A list of global features matching the length of the SMILES or target. Default: None
     graph_only
         If set to True, return only first graph without target values. Use for when unit-testing graph formation. Default: False
+    num_workers: int
+        Number of processes used to featurize the smiles. Values of 1 or less (or None) featurize serially, as do
+        inputs smaller than one chunk of work per process. On platforms that spawn processes (macOS, Windows), the
+        calling script needs an ``if __name__ == '__main__':`` guard to use more than one. Default: 1
+    mols: list of rdkit.Chem.Mol
+        The already parsed mols of the smiles, fx. from ``filter_smiles`` with ``return_mols=True``. If given, the
+        smiles are not parsed again. Default: None
     Returns
     --------
     list of Data
@@ -183,43 +357,70 @@ def construct_dataset(smiles: list[str], target: Union[list[int], list[float], n
 
     """
 
-    atom_featurizer = AtomFeaturizer(allowed_atoms=allowed_atoms,
-                                    atom_feature_list = atom_feature_list)
-
-    bond_featurizer = BondFeaturizer(bond_feature_list=bond_feature_list)
+    atom_featurizer, bond_featurizer = _get_featurizers(
+        tuple(allowed_atoms) if allowed_atoms is not None else None,
+        tuple(atom_feature_list) if atom_feature_list is not None else None,
+        tuple(bond_feature_list) if bond_feature_list is not None else None)
+
+    if graph_only:
+        if len(smiles) == 0:
+            return []
+        return _smile_to_graph(smiles[0], atom_featurizer, bond_featurizer, graph_only=True,
+                               mol=mols[0] if mols is not None else None)
+
+    if num_workers is None:
+        num_workers = 1
+
+    chunksize = 64
+
+    if len(smiles) == 0:
+        return []
+
+    if num_workers <= 1 or len(smiles) <= chunksize:
+        # The targets are converted into one tensor up front instead of one tensor per molecule. The rows are cloned,
+        # so that a graph does not hold on to (and pickle) the storage of every target.
+        target_tensor = torch.as_tensor(np.asarray(target, dtype=np.float32)).reshape(len(smiles), -1)
+
+        data = []
+        for i, smile in enumerate(smiles):
+            # TODO: Might need to be tested on multidim global feats
+            global_feat_value = _as_1d_tensor(global_features[i]) if global_features is not None else None
+            data.append(_smile_to_graph(smile, atom_featurizer, bond_featurizer, target_tensor[i].clone(),
+                                        global_feat_value, mol=mols[i] if mols is not None else None))
+        return data  # actual PyG graphs
+
+    def pool_args_iter():
+        for i, smile in enumerate(smiles):
+            mol_binary = mols[i].ToBinary(Chem.PropertyPickleOptions.AllProps) if mols is not None else None
+            yield smile, mol_binary, target[i], global_features[i] if global_features is not None else None
+
+    # Featurization is independent per molecule, so it is spread over a process pool. The featurizers are handed to
+    # every worker once by the initializer instead of with every task.
+    with multiprocessing.Pool(min(num_workers, -(-len(smiles) // chunksize)), initializer=_init_featurize_worker,
+                              initargs=(atom_featurizer, bond_featurizer)) as pool:
+        data = [pickle.loads(graph) for graph in pool.imap(_featurize_one, pool_args_iter(), chunksize=chunksize)]
 
+    return data  # actual PyG graphs
 
-    data = []
 
-    for (smile, i) in zip(smiles, range(len(smiles))):
-        mol = MolFromSmiles(smile)  # get into rdkit object
-        edge_index = dense_to_sparse(torch.tensor(rdmolops.GetAdjacencyMatrix(mol)))[0]
-        x = atom_featurizer(mol)  # creates node features
-        edge_attr = bond_featurizer(mol)  # creates edge attributes
-        
-        if graph_only:
-            data_temp = Data(x=x, edge_index=edge_index, edge_attr=edge_attr)
-            return data_temp
-
-        # Prepare the target `y_value`
-        y_value = torch.tensor(target[i], dtype=torch.float32)
-        if y_value.ndim == 0:
-            y_value = y_value.unsqueeze(0)  # Ensure `y_value` is at least 1-dimensional
-        data_temp = Data(x=x, edge_index=edge_index, edge_attr=edge_attr, y=y_value)
-
-        # TODO: Might need to be tested on multidim global feats
-        if global_features is not None:
-            global_feat_value = torch.tensor(global_features[i], dtype=torch.float32)
-            if global_feat_value.ndim == 0:
-                global_feat_value = global_feat_value.unsqueeze(0)  # Ensure it's at least 1-dimensional
-            data_temp['global_feats'] = global_feat_value
-        else:
-            data_temp['global_feats'] = None
-        # ------------------------------------------
+def _load_dataset(file_path: str) -> tuple:
+    """Loads the smiles, global features and graphs of a dataset stored with ``DataSet.save_dataset``. Datasets saved as
+    a pickled DataFrame by earlier versions can still be loaded."""
+    if zipfile.is_zipfile(file_path):
+        # The collated graph tensors are memory-mapped, so they are paged in from the file when accessed instead of
+        # being read into memory up front
+        saved = torch.load(file_path, weights_only=False, mmap=True, map_location='cpu')
+        print('Loaded dataset.')
+        return saved['smiles'], saved['global_features'], saved['graphs'].to_data_list()
 
-        data.append(data_temp)
+    with open(file_path, 'rb') as handle:
+        try:
+            df = pd.read_pickle(handle)
+            print('Loaded dataset.')
+        except:
+            raise ValueError('A dataset is stored as a DataFrame.')
 
-    return data  # actual PyG graphs
+    return np.array(df.smiles), np.array(df.global_features), list(df.graphs)
 
 
 ##########################################################################
@@ -266,7 +467,7 @@ class DataSet(DataLoad):
     Parameters
     ------------
     file_path: str
-        The path to a pickle file that should be loaded and the datasets therein used.
+        The path to a file saved with ``save_dataset`` that should be loaded and the datasets therein used.
     smiles: list of str
         List of smiles to be made into a graph.
     target: list of in or float
@@ -293,38 +494,39 @@ class DataSet(DataLoad):
         In the case of multi dimensional targets, columns that contain them. Default: None
     mask: list of bool
         In the case of multi-task learning, a mask that indicates which targets are missing. Default: None
+    num_workers: int
+        Number of threads used to parse the smiles during filtering and number of processes used to featurize them,
+        see ``filter_smiles`` and ``construct_dataset``. If None, the smiles are parsed with ``os.cpu_count()``
+        threads and featurized serially. Default: None
+    allow_dupes: bool
+        Decides if duplicate smiles are kept during filtering. If None, duplicates are only kept when global features
+        are given, since there can be multiple observations of the same molecule then. Default: None
     """
     def __init__(self, file_path: str = None, smiles: list[str] = None, target: Union[list[int], list[float],
     ndarray] = None, global_features:Union[list[float], ndarray] = None, filter: bool=True,allowed_atoms:list[str] = None,
     only_organic: bool = True, atom_feature_list: list[str] = None, bond_feature_list: list[str] = None,
     log: bool = False, root: str = None, indices:list[int] = None, fragmentation=None, custom_split=None, 
-    target_columns=None, mask=None):
+    target_columns=None, mask=None, num_workers: int = None, allow_dupes: bool = None):
         assert (file_path is not None) or (smiles is not None and target is not None),'path or (smiles and target) must given.'
         super().__int__(root)
 
-        allow_dupes = global_features is not None #in the case of global featuers, there will be multiple observations for the same molecule
+        if allow_dupes is None:
+            allow_dupes = global_features is not None #in the case of global featuers, there will be multiple observations for the same molecule
 
         if file_path is not None:
-            with open(file_path, 'rb') as handle:
-                try:
-                    df = pd.read_pickle(handle)
-                    print('Loaded dataset.')
-                except:
-                    raise ValueError('A dataset is stored as a DataFrame.')
-
-            self.smiles = np.array(df.smiles)
-
-            self.global_features = np.array(df.global_features)
-            self.graphs = list(df.graphs)
+            self.smiles, self.global_features, self.graphs = _load_dataset(file_path)
             
             self.target_columns = target_columns
         else:
+            # The mols parsed while filtering are reused to build the graphs
+            mols = None
             if filter:
-                self.smiles, self.raw_target, self.global_features, self.custom_split = filter_smiles(smiles, target,
+                self.smiles, self.raw_target, self.global_features, self.custom_split, mols = filter_smiles(smiles, target,
                                                                                    allowed_atoms= allowed_atoms,
                                                                                     only_organic=only_organic, log=log,
                                                                                    global_feats=global_features, custom_split=custom_split,
-                                                                                   allow_dupes=allow_dupes, target_columns=target_columns)
+                                                                                   allow_dupes=allow_dupes, target_columns=target_columns,
+                                                                                   num_workers=num_workers, return_mols=True)
             else:
                 self.smiles, self.raw_target = np.array(smiles), np.array(target)
                 self.global_features = np.array(global_features) if global_features is not None else None
@@ -337,18 +539,22 @@ class DataSet(DataLoad):
                                             global_features=self.global_features,
                                             allowed_atoms = allowed_atoms,
                                             atom_feature_list = atom_feature_list,
-                                            bond_feature_list = bond_feature_list)
+                                            bond_feature_list = bond_feature_list,
+                                            num_workers = num_workers,
+                                            mols = mols)
             for g in self.graphs:
                 assert g.edge_index.shape[1] == g.edge_attr.shape[0], "Mismatch between edge_index and edge_attr dimensions"
             
         self.allowed_atoms = allowed_atoms
         self.atom_feature_list = atom_feature_list
         self.bond_feature_list = bond_feature_list
+        self.num_workers = num_workers
         self._indices = indices
         self.num_node_features = self.graphs[0].num_node_features
         self.num_edge_features = self.graphs[0].num_edge_features
         self.data_name=None
         self.mean, self.std = None, None
+        self._analysis_cache = None
         
         self.mol_weights = np.zeros(len(self.smiles))
         for i in range(len(self.smiles)):
@@ -364,8 +570,11 @@ class DataSet(DataLoad):
     def standardize(target):
         if isinstance(target, Tensor):
             target = target.cpu().detach().numpy()
-        target_ = (target - np.mean(target)) / np.std(target)
-        return target_, np.mean(target), np.std(target)
+        target = np.asarray(target)
+        # The mean and std are computed once and reused for the returned scaling parameters
+        mean, std = target.mean(), target.std()
+        target_ = (target - mean) / std
+        return target_, mean, std
 
     @staticmethod
     def rescale(target, mean, std):
@@ -397,9 +606,11 @@ class DataSet(DataLoad):
 
 
     def save_dataset(self, filename:str=None):
-        """Loads the dataset (specifically the smiles, target, global features and graphs) to a pandas DataFrame and
-        dumps it into a pickle file. Saving and loading the same dataset is about 20x faster than recreating it from
-        scratch.
+        """Saves the dataset (specifically the smiles, target, global features and graphs) with ``torch.save``. The
+        graphs are collated into a single batch, so every graph attribute is written as one contiguous tensor instead of
+        pickling thousands of small ones. Saving and loading the same dataset is about 20x faster than recreating it
+        from scratch. The file is stored as ``<filename>.pt``; files saved as ``.pickle`` by earlier versions can still
+        be loaded. All graphs need to have the same attributes to be collated.
 
         Parameters
         ------------
@@ -419,13 +630,18 @@ class DataSet(DataLoad):
         if not os.path.exists(path):
             os.makedirs(path)
 
-        df_save = pd.DataFrame({'smiles':self.smiles,'target':self.raw_target,'global_features':self.global_features,
-                   'graphs':self.graphs})
+        keys = set(self.graphs[0].keys()) if len(self.graphs) > 0 else set()
+        for idx, graph in enumerate(self.graphs):
+            if set(graph.keys()) != keys:
+                raise ValueError(f'Graph {idx} has the attributes {sorted(graph.keys())}, while the first graph has '
+                                 f'{sorted(keys)}. All graphs need the same attributes to be saved.')
+
+        save = {'smiles':self.smiles,'target':self.raw_target,'global_features':self.global_features,
+                'graphs':Batch.from_data_list(self.graphs)}
 
-        path = os.path.join(path,filename+'.pickle')
+        path = os.path.join(path,filename+'.pt')
 
-        with open(path,'wb') as handle:
-            pickle.dump(df_save, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        torch.save(save, path)
 
         print(f'File saved at: {path}')
 
@@ -678,8 +894,19 @@ class DataSet(DataLoad):
 
         """
         from grape_chem.analysis import smiles_analysis
+        from dgllife.utils.analysis import analyze_mols
 
-        return smiles_analysis(self.smiles, path_to_export, download, plots, save_plots, fig_size, filter_output_txt)
+        # Analyzing parses every smiles, so the result is cached and only recomputed if the smiles change. Exporting
+        # the results still runs the analysis, since the files are written during it.
+        mol_analysis = None
+        if path_to_export is None and not download:
+            smiles_key = hash(tuple(self.smiles))
+            if self._analysis_cache is None or self._analysis_cache[0] != smiles_key:
+                self._analysis_cache = (smiles_key, analyze_mols(self.smiles))
+            mol_analysis = self._analysis_cache[1]
+
+        return smiles_analysis(self.smiles, path_to_export, download, plots, save_plots, fig_size, filter_output_txt,
+                               mol_analysis=mol_analysis)
 
 
 
@@ -797,7 +1024,8 @@ class DataSet(DataLoad):
                                             global_features=self.global_features,
                                             allowed_atoms=self.allowed_atoms,
                                             atom_feature_list=self.atom_feature_list,
-                                            bond_feature_list=self.bond_feature_list)
+                                            bond_feature_list=self.bond_feature_list,
+                                            num_workers=self.num_workers)
             # TODO: also work on fragments 
         train, val, test = split_data(self, split_type=split_type, split_frac=split_frac, custom_split=custom_split,
                    is_dmpnn=is_dmpnn,**kwargs)
@@ -889,7 +1117,7 @@ class GraphDataSet(DataSet):
     Parameters
     ----------
     file_path: str
-        The path to a pickle file that should be loaded and the datasets therein used.
+        The path to a file saved with ``save_dataset`` that should be loaded and the datasets therein used.
     smiles: list[str]
         List of smiles to be made into a graph.
     target: list[float]
@@ -945,7 +1173,7 @@ class GraphDataSet(DataSet):
         self.split_type = split_type
         self.split_frac = split_frac
 
-        assert np.sum(self.split_frac), 'Split fractions should add to 1.'
+        assert abs(sum(self.split_frac) - 1.0) < 1e-6, 'Split fractions should add to 1.'
 
         if split or (self.custom_split is not None):
             self.train, self.val, self.test = split_data(data = self, split_type = self.split_type,
@@ -1018,17 +1246,7 @@ class FragmentGraphDataSet(DataLoad):
         super().__int__(root)
 
         if file_path is not None:
-            with open(file_path, 'rb') as handle:
-                try:
-                    df = pd.read_pickle(handle)
-                    print('Loaded dataset.')
-                except:
-                    raise ValueError('A dataset is stored as a DataFrame.')
-
-            self.smiles = np.array(df.smiles)
-
-            self.global_features = np.array(df.global_features)
-            self.graphs = list(df.graphs)
+            self.smiles, self.global_features, self.graphs = _load_dataset(file_path)
 
         else:
             if filter:
@@ -52,10 +52,10 @@ def one_hot(input_, mapping, encode_unknown = True):
 
     encoding = list(map(lambda x: x == input_, mapping))
 
-    if encode_unknown and (input_ not in mapping):
-        encoding.append(True)
-    elif encode_unknown:
-        encoding.append(False)
+    # The comparison against the mapping was already done for the encoding, so it is reused instead of testing
+    # membership with another scan of the mapping.
+    if encode_unknown:
+        encoding.append(not any(encoding))
 
     assert np.sum(np.array(encoding)) == 1, ('One of the elements has to be True, consider checking the values'
                                              'or encoding the unknowns.')
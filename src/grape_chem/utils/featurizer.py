@@ -25,6 +25,28 @@ __all__ = [
 class FunctionNotWellDefined(Exception):
     pass
 
+# Default features of the featurizers, following [1, 2] in their references. They are copied into a new list for
+# every featurizer, since ``extend_features`` appends to it.
+_DEFAULT_ATOM_FEATURES = (
+    'atom_type_one_hot',
+    'atom_total_num_H_one_hot',
+    'atom_total_degree_one_hot',
+    'atom_explicit_valence_one_hot',
+    'atom_hybridization_one_hot',
+    'atom_is_aromatic',
+    'atom_is_chiral_center',
+    'atom_chirality_type_one_hot',
+    'atom_chiral_tag_one_hot',
+    'atom_formal_charge'
+)
+
+_DEFAULT_BOND_FEATURES = (
+    'bond_type_one_hot',
+    'bond_is_conjugated',
+    'bond_is_in_ring',
+    'bond_stereo_one_hot'
+)
+
 ##########################################################################
 ########### Atom featurizer ##############################################
 ##########################################################################
@@ -158,18 +180,7 @@ class AtomFeaturizer(object):
         }
 
         if atom_feature_list is None:
-            atom_feature_list = [
-                'atom_type_one_hot',
-                'atom_total_num_H_one_hot',
-                'atom_total_degree_one_hot',
-                'atom_explicit_valence_one_hot',
-                'atom_hybridization_one_hot',
-                'atom_is_aromatic',
-                'atom_is_chiral_center',
-                'atom_chirality_type_one_hot',
-                'atom_chiral_tag_one_hot',
-                'atom_formal_charge'
-            ]
+            atom_feature_list = list(_DEFAULT_ATOM_FEATURES)
 
         self.atom_feature_list = atom_feature_list
 
@@ -344,12 +355,7 @@ class BondFeaturizer(object):
         }
 
         if bond_feature_list is None:
-            bond_feature_list = [
-                'bond_type_one_hot',
-                'bond_is_conjugated',
-                'bond_is_in_ring',
-                'bond_stereo_one_hot'
-            ]
+            bond_feature_list = list(_DEFAULT_BOND_FEATURES)
 
         self.bond_feature_list = bond_feature_list
 
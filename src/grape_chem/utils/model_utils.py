@@ -11,7 +11,6 @@ from torch_geometric.loader import DataLoader
 from torch_geometric.data import Data
 from torch_geometric.data import Batch
 from tqdm import tqdm
-from sklearn.metrics import mean_squared_error, mean_absolute_error, r2_score, root_mean_squared_error, mean_absolute_percentage_error
 from grape_chem.utils import DataSet
 import matplotlib.pyplot as plt
 import os
@@ -140,7 +139,8 @@ def train_model(model: torch.nn.Module, loss_func: Union[Callable,str], optimize
                 train_data_loader: Union[list, Data, DataLoader], val_data_loader: Union[list, Data, DataLoader],
                 device: str = None, epochs: int = 50, batch_size: int = 32,
                 early_stopper: EarlyStopping = None, scheduler: lr_scheduler = None,
-                tuning: bool = False, model_name:str = None, model_needs_frag : bool = False,) -> tuple[list,list]:
+                tuning: bool = False, model_name:str = None, model_needs_frag : bool = False,
+                num_workers: int = 0) -> tuple[list,list]:
     """Auxiliary function to train and test a given model and return the (training, test) losses.
     Can initialize DataLoaders if only lists of Data objects are given.
 
@@ -171,6 +171,9 @@ def train_model(model: torch.nn.Module, loss_func: Union[Callable,str], optimize
         Will turn off the early stopping, meant for hyperparameter optimziation.
     model_name:str
         If given, it will be used to save it if early stopping did not set in. Default: None
+    num_workers: int
+        Number of worker processes of the DataLoaders if not given directly. The workers are kept alive across epochs
+        and prefetch batches while the model trains. Default: 0 (batches are loaded in the main process)
 
     Returns
     ---------
@@ -197,11 +200,18 @@ def train_model(model: torch.nn.Module, loss_func: Union[Callable,str], optimize
                 exclude_keys = ["frag_graphs", "motif_graphs"]
     
 
+    # Pinned batches let the copies to a cuda device run asynchronously (non_blocking) with the computation
+    loader_kwargs = {'pin_memory': torch.device(device).type == 'cuda'}
+    if num_workers > 0:
+        loader_kwargs.update(num_workers=num_workers, persistent_workers=True, prefetch_factor=4)
+
     if not isinstance(train_data_loader, DataLoader):
-        train_data_loader = DataLoader(train_data_loader, batch_size = batch_size, exclude_keys=exclude_keys,)
+        train_data_loader = DataLoader(train_data_loader, batch_size = batch_size, exclude_keys=exclude_keys,
+                                       **loader_kwargs)
 
     if not isinstance(val_data_loader, DataLoader):
-        val_data_loader = DataLoader(val_data_loader, batch_size = batch_size, exclude_keys=exclude_keys,)
+        val_data_loader = DataLoader(val_data_loader, batch_size = batch_size, exclude_keys=exclude_keys,
+                                     **loader_kwargs)
 
     model.train()
     train_loss = []
@@ -227,7 +237,7 @@ def train_model(model: torch.nn.Module, loss_func: Union[Callable,str], optimize
         nested and batched PyG Data to a cuda device
         """
         if isinstance(data, torch.Tensor):
-            return data.to(device)
+            return data.to(device, non_blocking=True)
         elif isinstance(data, list):
             return [move_to_device(item, device) for item in data]
         elif isinstance(data, dict):
@@ -237,21 +247,23 @@ def train_model(model: torch.nn.Module, loss_func: Union[Callable,str], optimize
 
     with tqdm(total = epochs) as pbar:
         for i in range(epochs):
-            temp = np.zeros(len(train_data_loader))
+            # The batch losses are summed on the device and only moved to the cpu once per epoch, so there is no
+            # device-host synchronization after every batch
+            loss_sum = torch.zeros((), device=device)
             for idx, batch in enumerate(train_data_loader):
                 optimizer.zero_grad()
 
                 out = model(move_to_device(batch, device),)
-                out = handle_heterogenous_sizes(batch.y.to(device), out)
+                out = handle_heterogenous_sizes(batch.y.to(device, non_blocking=True), out)
 
                 if out.dim() == 2:
                     #TODO: less messy handling of outputs 
-                    by = batch.y.view(out.shape[0], out.shape[1]).to(device)
+                    by = batch.y.view(out.shape[0], out.shape[1]).to(device, non_blocking=True)
                 else:
-                    by = batch.y.to(device)
+                    by = batch.y.to(device, non_blocking=True)
             
                 if hasattr(batch, 'mask') and batch.mask is not None:
-                    mask = batch.mask.to(device)
+                    mask = batch.mask.to(device, non_blocking=True)
                     if mask.sum() == 0:
                         continue  # Skip this batch
 
@@ -262,21 +274,21 @@ def train_model(model: torch.nn.Module, loss_func: Union[Callable,str], optimize
                     # no mask; all targets assumed present
                     loss_train = loss_func(out, by)
 
-                temp[idx] = loss_train.detach().cpu().numpy()
+                loss_sum += loss_train.detach()
 
                 loss_train.backward()
                 optimizer.step()
                 #
-            loss_train = np.mean(temp)
+            loss_train = (loss_sum / len(train_data_loader)).item()
             train_loss.append(loss_train)
 
-            temp = np.zeros(len(val_data_loader))
+            loss_sum = torch.zeros((), device=device)
             for idx, batch in enumerate(val_data_loader):
                 out = model(move_to_device(batch, device),)
                 out = handle_heterogenous_sizes(batch.y, out)
-                temp[idx] = loss_func(batch.y, out).detach().cpu().numpy()
+                loss_sum += loss_func(batch.y, out).detach()
 
-            loss_val = np.mean(temp)
+            loss_val = (loss_sum / len(val_data_loader)).item()
             val_loss.append(loss_val)
 
             if i%2 == 0:
@@ -375,7 +387,8 @@ def train_model_jit(
 
     with tqdm(total=epochs) as pbar:
         for epoch in range(epochs):
-            temp = np.zeros(len(train_data_loader))
+            # Summed on the device and moved to the cpu once per epoch, as in train_model
+            loss_sum = torch.zeros((), device=device)
             for idx, batch in enumerate(train_data_loader):
                 optimizer.zero_grad()
                 # Extract tensors from batch (same as above)
@@ -471,17 +484,17 @@ def train_model_jit(
                     # no mask; all targets assumed present
                     loss_train = loss_func(out, by)
 
-                temp[idx] = loss_train.detach().cpu().numpy()
+                loss_sum += loss_train.detach()
 
                 loss_train.backward()
                 optimizer.step()
 
-            loss_train = np.mean(temp)
+            loss_train = (loss_sum / len(train_data_loader)).item()
             train_loss.append(loss_train)
 
             # Validation loop
             model.eval()
-            temp = np.zeros(len(val_data_loader))
+            loss_sum = torch.zeros((), device=device)
             with torch.no_grad():
                 for idx, batch in enumerate(val_data_loader):
                     # Extract tensors from batch (same as above)
@@ -577,9 +590,9 @@ def train_model_jit(
                         loss_val = loss_per_element.sum() / mask.sum()
                     else:
                         loss_val = loss_func(out, by)
-                    temp[idx] = loss_val.detach().cpu().numpy()
+                    loss_sum += loss_val.detach()
 
-            loss_val = np.mean(temp)
+            loss_val = (loss_sum / len(val_data_loader)).item()
             val_loss.append(loss_val)
             model.train()  # Switch back to training mode
 
@@ -893,27 +906,27 @@ def test_model(model: torch.nn.Module, test_data_loader: Union[list, Data, DataL
 
     model.eval()
 
-    with tqdm(total = len(test_data_loader)) as pbar:
+    # The batch outputs are collected and concatenated once at the end, instead of copying the growing result on
+    # every batch
+    preds_list = []
+    latents_list = []
+
+    # No autograd state is needed for testing, the predictions are inference tensors
+    with tqdm(total = len(test_data_loader)) as pbar, torch.inference_mode():
 
         for idx, batch in enumerate(test_data_loader):
             # TODO: Broaden use of return_latents
             out = model(batch.to(device))
+            preds_list.append(out.detach())
             if return_latents:
                lat = model(batch.to(device), return_lats=True)
-
-            # Concatenate predictions and latents
-            if idx == 0:
-                preds = out
-                if return_latents:
-                    latents = lat
-            else:
-                preds = torch.concat([preds,out],dim=0)
-                if return_latents:
-                    latents = torch.concat((latents, lat), dim=0)
+               latents_list.append(lat.detach())
 
             pbar.update(1)
 
+    preds = torch.cat(preds_list, dim=0)
     if return_latents:
+        latents = torch.cat(latents_list, dim=0)
         return preds, latents
     return preds
 
@@ -1163,8 +1176,8 @@ def pred_metric(
 ) -> List[float]:
     """
     A function to evaluate continuous predictions compared to targets with different metrics. It can
-    take either Tensors or ndarrays and will automatically convert them to the correct format. Partly makes use of
-    sklearn and their implementations. The options for metrics are:
+    take either Tensors or ndarrays and will automatically convert them to the correct format. The metrics follow the
+    definitions of sklearn, but share a single computation of the errors. The options for metrics are:
 
     * ``MSE``: Mean Squared Error
     * ``RMSE``: Root Mean Squared Error
@@ -1227,40 +1240,61 @@ def pred_metric(
     # Flatten the arrays for certain metrics
     target_flat = target.flatten()
     prediction_flat = prediction.flatten()
+    if target_flat.shape != prediction_flat.shape:
+        raise ValueError(f'The prediction ({prediction.shape}) and target ({target.shape}) must have the same size.')
+
+    # The error vectors are computed once and shared by all metrics, instead of every metric doing its own passes
+    # over the arrays
+    err = target_flat - prediction_flat
+    abs_err = np.abs(err)
+    sq_err = err * err
+    rel_err = None
+
+    def calc_rel_err():
+        return abs_err / (np.abs(target_flat) + epsilon)
 
     # Define a helper function to calculate MARE
-    def calc_MARE(ym, yp):
-        RAE = []
+    def calc_MARE(ym):
         pstd = np.std(ym)
-        for i in range(len(ym)):
-            if -0.1 <= ym[i] <= 0.1:
-                RAE.append(abs(ym[i] - yp[i]) / (pstd + epsilon) * 100)
-            else:
-                RAE.append(abs(ym[i] - yp[i]) / (abs(ym[i]) + epsilon) * 100)
+        # Targets close to zero are scaled by the standard deviation instead of their own magnitude
+        near_zero = (ym >= -0.1) & (ym <= 0.1)
+        RAE = abs_err / (np.where(near_zero, pstd, np.abs(ym)) + epsilon) * 100
         mare = np.mean(RAE)
         return mare
 
+    def calc_r2():
+        # Like sklearn's r2_score, the score is computed per target column and averaged
+        num_cols = target.shape[1] if target.ndim == 2 else 1
+        sq_err_cols = sq_err.reshape(-1, num_cols)
+        target_cols = target_flat.reshape(-1, num_cols)
+        ss_res = sq_err_cols.sum(axis=0)
+        ss_tot = ((target_cols - target_cols.mean(axis=0)) ** 2).sum(axis=0)
+        # A constant target gives a score of 1 for a perfect prediction and 0 otherwise, as in sklearn
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scores = np.where(ss_tot != 0, 1 - ss_res / ss_tot, np.where(ss_res == 0, 1.0, 0.0))
+        return np.mean(scores)
+
     for metric_ in metrics:
         metric_lower = metric_.lower()
         if metric_lower == 'mse':
-            mse = mean_squared_error(target, prediction)
+            mse = np.mean(sq_err)
             results['mse'] = mse
             prints.append(f'MSE: {mse:.3f}')
         elif metric_lower == 'rmse':
-            mse = mean_squared_error(target, prediction)
+            mse = np.mean(sq_err)
             rmse = np.sqrt(mse)
             results['rmse'] = rmse
             prints.append(f'RMSE: {rmse:.3f}')
         elif metric_lower == 'sse':
-            sse = np.sum((target - prediction) ** 2)
+            sse = np.sum(sq_err)
             results['sse'] = sse
             prints.append(f'SSE: {sse:.3f}')
         elif metric_lower == 'mae':
-            mae = mean_absolute_error(target, prediction)
+            mae = np.mean(abs_err)
             results['mae'] = mae
             prints.append(f'MAE: {mae:.3f}')
         elif metric_lower == 'r2':
-            r2 = r2_score(target, prediction)
+            r2 = calc_r2()
             results['r2'] = r2
             prints.append(f'R2: {r2:.3f}')
         elif metric_lower == 'pearson':
@@ -1271,22 +1305,25 @@ def pred_metric(
             results['pearson'] = pearson_corr
             prints.append(f'Pearson Corr Coeff: {pearson_corr:.3f}')
         elif metric_lower == 'mape':
-            mape = mean_absolute_percentage_error(target, prediction) * 100  # Convert to percentage
+            # sklearn's definition, which bounds the denominator by the machine epsilon
+            mape = np.mean(abs_err / np.maximum(np.abs(target_flat), np.finfo(np.float64).eps)) * 100  # Convert to percentage
             results['mape'] = mape
             prints.append(f'MAPE: {mape:.3f}%')
         elif metric_lower == 'mre':
-            mre = np.mean(np.abs((target - prediction) / (np.abs(target) + epsilon))) * 100
+            rel_err = calc_rel_err() if rel_err is None else rel_err
+            mre = np.mean(rel_err) * 100
             results['mre'] = mre
             prints.append(f'MRE: {mre:.3f}%')
             if mre > 100:
-                median_re = np.median(np.abs((target - prediction) / (np.abs(target) + epsilon))) * 100
+                median_re = np.median(rel_err) * 100
                 prints.append(f'Median Relative Error: {median_re:.3f}%')
         elif metric_lower == 'mdape':
-            mdape = np.median(np.abs((target - prediction) / (np.abs(target) + epsilon))) * 100
+            rel_err = calc_rel_err() if rel_err is None else rel_err
+            mdape = np.median(rel_err) * 100
             results['mdape'] = mdape
             prints.append(f'MDAPE: {mdape:.3f}%')
         elif metric_lower == 'mare':
-            mare = calc_MARE(target_flat, prediction_flat)
+            mare = calc_MARE(target_flat)
             results['mare'] = mare
             prints.append(f'MARE: {mare:.3f}%')
         else: